@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+
+Work Log Database Benchmarks
+
+Times the work log read paths on an in-memory database filled with generated tasks
+and concurrent inserts, straight and through the group commit writer, on a database file
+
+    python3 wl_bench.py reads --rows 1000000
+    python3 wl_bench.py writes --inserts 4000
+
+"""
+
+import argparse
+import os
+import tempfile
+import threading
+from datetime import date, timedelta
+from time import perf_counter
+
+import wlogdb
+
+
+def fill_database(rows: int, batch_size: int = 10000):
+    """
+    Fills the database with generated tasks
+    :param rows: int
+    :param batch_size: int
+    :return: None
+    """
+    first_day = date(2016, 1, 1)
+    for start in range(0, rows, batch_size):
+        batch = [dict(task_00_project="project {}".format(i % 20), task_1_user_name="user {}".format(i % 50),
+                      task_0_name="task {}".format(i), task_3_duration=i % 480, task_4_notes="notes",
+                      task_2_date=first_day + timedelta(days=i % 1000))
+                 for i in range(start, min(start + batch_size, rows))]
+        with wlogdb.db.atomic():
+            wlogdb.Task.insert_many(batch).execute()
+
+
+def time_it(name: str, read):
+    """
+    Times a full scan, touching one field of every row so nothing gets skipped
+    :param name: str
+    :param read: function returning an iterable of tasks
+    :return: float, seconds
+    """
+    start = perf_counter()
+    total = 0
+    for task in read():
+        total += task[5] if isinstance(task, tuple) else task.task_3_duration
+    elapsed = perf_counter() - start
+    print("{:<30}{:>10.3f} s".format(name, elapsed))
+    return elapsed
+
+
+def bench_reads(rows: int):
+    """
+    Scans rows tasks as models, tuples and TaskRecords
+    :param rows: int
+    :return: None
+    """
+    wlogdb.configure_database(":memory:")
+    wlogdb.initialize()
+    fill_database(rows)
+    print("Scanning {} tasks".format(rows))
+
+    models = time_it("Task models", lambda: wlogdb.get_tasks_by_date().iterator())
+    tuples = time_it(".tuples()", lambda: wlogdb.get_tasks_by_date().select(
+        *[getattr(wlogdb.Task, field) for field in wlogdb.TaskRecord._fields]).tuples().iterator())
+    records = time_it("read_records", lambda: wlogdb.read_records(wlogdb.get_tasks_by_date()))
+
+    print("Speed up: .tuples() x{:.1f}, read_records x{:.1f}".format(models / tuples, models / records))
+
+
+def inserts_per_second(producers: int, inserts: int) -> float:
+    """
+    Splits inserts among producer threads, each one adding tasks through wlogdb.write
+    :param producers: int
+    :param inserts: int, in total
+    :return: float
+    """
+    def produce(count):
+        for i in range(count):
+            wlogdb.write("create", dict(task_1_user_name="user", task_0_name="task {}".format(i),
+                                        task_3_duration=i % 480, task_4_notes="notes"))
+        wlogdb.db.close()
+
+    threads = [threading.Thread(target=produce, args=(inserts // producers,)) for _ in range(producers)]
+    start = perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (inserts // producers) * producers / (perf_counter() - start)
+
+
+def bench_writes(inserts: int):
+    """
+    Concurrent inserts at 1, 8 and 64 producers, each one committing on its own and through the task writer
+    :param inserts: int
+    :return: None
+    """
+    print("{:<12}{:>16}{:>16}".format("Producers", "direct/s", "group commit/s"))
+    for producers in (1, 8, 64):
+        with tempfile.TemporaryDirectory() as directory:
+            wlogdb.configure_database(os.path.join(directory, "bench.db"), storage="file")
+            wlogdb.initialize()
+            direct = inserts_per_second(producers, inserts)
+            wlogdb.start_task_writer()
+            grouped = inserts_per_second(producers, inserts)
+            wlogdb.stop_task_writer()
+            wlogdb.db.close()
+        print("{:<12}{:>16.0f}{:>16.0f}".format(producers, direct, grouped))
+
+
+def main():
+    """
+    Main Function
+    :return: None
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the work log")
+    parser.add_argument("bench", choices=["reads", "writes"], nargs="?", default="reads")
+    parser.add_argument("--rows", type=int, default=1000000, help="number of tasks to scan")
+    parser.add_argument("--inserts", type=int, default=4000, help="number of tasks to insert")
+    args = parser.parse_args()
+
+    if args.bench == "reads":
+        bench_reads(args.rows)
+    else:
+        bench_writes(args.inserts)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,37 @@
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
-from datetime import date
+from datetime import date, datetime
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+from unittest import mock
 
 import wlogdb
+from peewee import IntegrityError
+
+
+def setUpModule():
+    # work on an in-memory copy, so the tests neither clobber work_log.db nor each other
+    wlogdb.configure_database("work_log.db", storage="preload", write_back=False)
+    wlogdb.initialize()
+
+
+class FileDatabaseTestCase(unittest.TestCase):
+    """
+    Runs each test on its own, empty database file, back on the in-memory copy afterwards
+    """
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        wlogdb.configure_database(os.path.join(self.directory.name, "test.db"), storage="file")
+        wlogdb.initialize()
+
+    def tearDown(self):
+        setUpModule()
+        self.directory.cleanup()
 
 
 class ShowHelpMessageTest(unittest.TestCase):
@@ -29,6 +59,12 @@ class ShowHelpMessageTest(unittest.TestCase):
         next2 = wlogdb.next_task(3, wlogdb.Task.select())
         self.assertEqual(next2, 3)
 
+    def test_task_at(self):
+        tasks = wlogdb.get_tasks_by_date().order_by(wlogdb.Task.task_2_date, wlogdb.Task.id)
+        self.assertEqual([wlogdb.task_at(tasks, ti).id for ti in range(3)], [task.id for task in tasks][:3])
+        with self.assertRaises(wlogdb.Task.DoesNotExist):
+            wlogdb.task_at(tasks, tasks.count())
+
     def test_previous_task(self):
         prev1 = wlogdb.previous_task(0, wlogdb.Task.select())
         self.assertEqual(prev1, 0)
@@ -86,6 +122,12 @@ class ShowHelpMessageTest(unittest.TestCase):
         tasks_with_duration9999 = wlogdb.get_filtered_tasks("project", attribute_to_filter=wlogdb.Task.task_00_project)
         self.assertEqual(tasks_with_duration9999[0].task_3_duration, 9999)
 
+    def test_read_records(self):
+        records = list(wlogdb.read_records(wlogdb.get_tasks_by_date()))
+        self.assertEqual(len(records), len(wlogdb.get_tasks_by_date()))
+        self.assertIsInstance(records[0], wlogdb.TaskRecord)
+        self.assertIsInstance(records[0].task_2_date, date)
+
     def test_process_raw_time(self):
         with self.assertLogs() as l:
             wlogdb.process_raw_time("", "raw_time")
@@ -117,6 +159,294 @@ class ShowHelpMessageTest(unittest.TestCase):
                 log.output)
 
 
+@mock.patch("wlogdb.screen_size", return_value=(15, 30))  # 6 rows per page
+class TableTest(unittest.TestCase):
+    def test_rows_per_page(self, screen_size):
+        self.assertEqual(wlogdb.rows_per_page(), 15 - wlogdb.TABLE_CHROME_LINES)
+        screen_size.return_value = (2, 30)
+        self.assertEqual(wlogdb.rows_per_page(), 1)
+
+    def test_page_count(self, screen_size):
+        self.assertEqual(wlogdb.page_count(0), 1)
+        self.assertEqual(wlogdb.page_count(6), 1)
+        self.assertEqual(wlogdb.page_count(7), 2)
+
+    def test_lines_cut_to_width(self, screen_size):
+        table = wlogdb.render_table("A title longer than thirty characters", ["Notes"],
+                                    [["x" * 100]], page=0, total_pages=1)
+        for line in table.splitlines():
+            self.assertLessEqual(len(line), 30)
+
+    def test_numbers_follow_the_page(self, screen_size):
+        table = wlogdb.render_table("Title", ["Date"], [["01/10/2016"], ["02/10/2016"]], page=2, total_pages=3)
+        lines = table.splitlines()
+        self.assertTrue(lines[4].startswith("13 "))
+        self.assertTrue(lines[5].startswith("14 "))
+        self.assertIn("Page 3 of 3", table)
+
+    def test_date_pages_are_clamped(self, screen_size):
+        list_of_dates = ["0{}/10/2016".format(day) for day in range(1, 8)]  # 2 pages
+        with mock.patch("wlogdb.show_dates_with_tasks", return_value=list_of_dates) as show_dates, \
+                mock.patch("builtins.input", side_effect=["p", "n", "n", "7"]):
+            self.assertEqual(wlogdb.safe_date_choice_input(list_of_dates), date(2016, 10, 7))
+        self.assertEqual([call.args for call in show_dates.call_args_list], [(0,), (1,), (1,)])
+
+
+class SoftDeleteTest(unittest.TestCase):
+    def setUp(self):
+        del wlogdb.deleted_this_session[:]  # a session per test
+        self.task = wlogdb.Task.create(task_00_project="soft delete project", task_1_user_name="name_of_user",
+                                       task_0_name="task to delete", task_3_duration=1,
+                                       task_4_notes="notes", task_2_date=wlogdb.date.today()
+                                       )
+
+    def tearDown(self):
+        self.task.delete_instance()
+
+    def test_deleted_task_not_found(self):
+        wlogdb.soft_delete_task(self.task)
+        tasks = wlogdb.get_filtered_tasks("soft delete project", attribute_to_filter=wlogdb.Task.task_00_project)
+        self.assertEqual(len(tasks), 0)
+
+    def test_undo_delete(self):
+        wlogdb.soft_delete_task(self.task)
+        self.assertEqual(wlogdb.undo_delete().id, self.task.id)
+        tasks = wlogdb.get_filtered_tasks("soft delete project", attribute_to_filter=wlogdb.Task.task_00_project)
+        self.assertEqual(len(tasks), 1)
+
+    def test_undo_leaves_other_sessions_deletes_alone(self):
+        wlogdb.soft_delete_task(self.task)
+        other = wlogdb.Task.create(task_00_project="soft delete project", task_1_user_name="someone else",
+                                   task_0_name="deleted by someone else", task_3_duration=1,
+                                   task_4_notes="notes", task_5_deleted_at=datetime.now())
+        self.assertEqual(wlogdb.undo_delete().id, self.task.id)
+        self.assertIsNone(wlogdb.undo_delete())
+        other.delete_instance()
+
+    def test_purge_keeps_tasks_within_undo_window(self):
+        wlogdb.soft_delete_task(self.task)
+        wlogdb.purge_deleted_tasks()
+        self.assertTrue(wlogdb.Task.select().where(wlogdb.Task.id == self.task.id).exists())
+
+    def test_purge_removes_old_tombstones(self):
+        self.task.task_5_deleted_at = datetime.now() - wlogdb.UNDO_WINDOW * 2
+        self.task.save()
+        self.assertGreaterEqual(wlogdb.purge_deleted_tasks(batch_size=1), 1)
+        self.assertFalse(wlogdb.Task.select().where(wlogdb.Task.id == self.task.id).exists())
+
+
+class MaintainDatabaseTest(FileDatabaseTestCase):
+    def test_second_run_reclaims_purged_pages(self):
+        wlogdb.maintain_database()  # switches the database to incremental vacuum
+        long_ago = datetime.now() - wlogdb.UNDO_WINDOW * 2
+        with wlogdb.db.atomic():
+            wlogdb.Task.insert_many([dict(task_1_user_name="user", task_0_name="task", task_3_duration=1,
+                                          task_4_notes="notes " * 20, task_5_deleted_at=long_ago)
+                                     for _ in range(2000)]).execute()
+
+        report = wlogdb.maintain_database()
+        self.assertEqual(report["purged"], 2000)
+        self.assertGreater(report["reclaimed"], 10 * 4096)
+        self.assertEqual(wlogdb.db.execute_sql("PRAGMA freelist_count").fetchone()[0], 0)
+
+
+class ConfigureDatabaseTest(unittest.TestCase):
+    def tearDown(self):
+        setUpModule()
+
+    def test_memory_database_starts_empty(self):
+        wlogdb.configure_database(":memory:")
+        wlogdb.initialize()
+        self.assertEqual(wlogdb.Task.select().count(), 0)
+
+    def test_unknown_storage(self):
+        with self.assertRaises(ValueError):
+            wlogdb.configure_database("work_log.db", storage="tape")
+
+    def test_preload_writes_back(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "preloaded.db")
+            wlogdb.configure_database(path, storage="preload")
+            wlogdb.initialize()
+            wlogdb.Task.create(task_1_user_name="name_of_user", task_0_name="preloaded",
+                               task_3_duration=1, task_4_notes="notes")
+            wlogdb.write_back_database()
+            wlogdb.configure_database(path, storage="file")
+
+            written = sqlite3.connect(path)
+            self.assertEqual(written.execute("SELECT task_0_name FROM task").fetchall(), [("preloaded",)])
+            written.close()
+
+
+class PreloadWriteBackTest(FileDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.directory.name, "test.db")
+        wlogdb.configure_database(self.path, storage="preload")
+        wlogdb.Task.create(task_1_user_name="preloaded", task_0_name="task", task_3_duration=1,
+                           task_4_notes="notes")
+
+    def tearDown(self):
+        wlogdb.configure_database(self.path, storage="file")  # nothing left to write back at exit
+        super().tearDown()
+
+    def test_unchanged_file_is_written_back(self):
+        self.assertEqual(wlogdb.write_back_database(), self.path)
+
+    def test_changed_file_is_not_overwritten(self):
+        other_session = sqlite3.connect(self.path)
+        other_session.execute("INSERT INTO task (task_00_project, task_1_user_name, task_0_name, task_3_duration, "
+                              "task_2_date, task_4_notes) VALUES ('p', 'other', 't', 1, '2016-10-01', 'n')")
+        other_session.commit()
+        other_session.close()
+
+        saved_to = wlogdb.write_back_database()
+        self.assertNotEqual(saved_to, self.path)
+        file_session = sqlite3.connect(self.path)
+        self.assertEqual(file_session.execute("SELECT task_1_user_name FROM task").fetchall(), [("other",)])
+        file_session.close()
+        saved_session = sqlite3.connect(saved_to)
+        self.assertEqual(saved_session.execute("SELECT task_1_user_name FROM task").fetchall(), [("preloaded",)])
+        saved_session.close()
+
+
+class PerEmployeeReportsTest(FileDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        for user, duration, day in [("ana", 30, 3), ("ana", 45, 20), ("bob", 60, 3), ("bob", 15, 1)]:
+            wlogdb.Task.create(task_1_user_name=user, task_0_name="task", task_3_duration=duration,
+                               task_4_notes="notes", task_2_date=date(2016, 10 if day != 1 else 11, day))
+
+    def test_month_range_december(self):
+        self.assertEqual(wlogdb.month_range("2016-12"), (date(2016, 12, 1), date(2017, 1, 1)))
+
+    def test_per_employee_reports(self):
+        output_dir = os.path.join(self.directory.name, "reports")
+        reports = wlogdb.per_employee_reports("2016-10", output_dir, workers=2)
+        self.assertEqual([(user, tasks, minutes) for user, path, tasks, minutes in reports],
+                         [("ana", 2, 75), ("bob", 1, 60)])
+        with open(reports[0][1]) as report:
+            self.assertEqual(report.read().splitlines()[-1], "Total,,,75,")
+
+    def test_similar_names_get_their_own_report(self):
+        for user in ("ana b", "ana_b", "ana.b"):
+            wlogdb.Task.create(task_1_user_name=user, task_0_name="task", task_3_duration=10,
+                               task_4_notes="notes", task_2_date=date(2016, 10, 5))
+        output_dir = os.path.join(self.directory.name, "reports")
+        reports = wlogdb.per_employee_reports("2016-10", output_dir, workers=3)
+        self.assertEqual(len({path for user, path, tasks, minutes in reports}), 5)
+        self.assertEqual(len(os.listdir(output_dir)), 5)
+
+    def test_database_path_with_uri_characters(self):
+        path = os.path.join(self.directory.name, "odd ?#% name.db")
+        wlogdb.configure_database(path, storage="file")
+        wlogdb.initialize()
+        wlogdb.Task.create(task_1_user_name="ana", task_0_name="task", task_3_duration=30,
+                           task_4_notes="notes", task_2_date=date(2016, 10, 3))
+        reports = wlogdb.per_employee_reports("2016-10", os.path.join(self.directory.name, "reports"), workers=1)
+        self.assertEqual([(user, tasks) for user, path, tasks, minutes in reports], [("ana", 1)])
+
+
+class TaskWriterTest(FileDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        wlogdb.start_task_writer()
+
+    def tearDown(self):
+        wlogdb.stop_task_writer()
+        super().tearDown()
+
+    def create_tasks(self, count):
+        for i in range(count):
+            wlogdb.write("create", dict(task_1_user_name="writer", task_0_name="task {}".format(i),
+                                        task_3_duration=1, task_4_notes="notes"))
+        wlogdb.db.close()
+
+    def test_concurrent_writes_are_committed(self):
+        threads = [threading.Thread(target=self.create_tasks, args=(25,)) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(wlogdb.Task.select().count(), 200)
+
+    def test_writes_after_stop_are_refused(self):
+        writer = wlogdb.task_writer
+        wlogdb.stop_task_writer()
+        with self.assertRaises(RuntimeError):
+            writer.submit(wlogdb.Task.create, task_1_user_name="writer", task_0_name="late",
+                          task_3_duration=1, task_4_notes="notes")
+        writer.stop()  # stopping twice doesn't hang either
+
+    def test_no_writer_on_memory_database(self):
+        wlogdb.stop_task_writer()
+        wlogdb.configure_database("work_log.db", storage="preload", write_back=False)
+        with self.assertRaises(ValueError):
+            wlogdb.start_task_writer()
+        self.assertIsNone(wlogdb.task_writer)
+
+    def test_failing_write_raises_in_its_caller(self):
+        with self.assertRaises(IntegrityError):
+            wlogdb.write("create", dict(task_1_user_name=None, task_0_name="no user",
+                                        task_3_duration=1, task_4_notes="notes"))
+        task_id = wlogdb.write("create", dict(task_1_user_name="writer", task_0_name="task",
+                                              task_3_duration=1, task_4_notes="notes"))
+        self.assertTrue(wlogdb.Task.select().where(wlogdb.Task.id == task_id).exists())
+
+
+class ServedTaskWriterTest(FileDatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        wlogdb.start_task_writer()
+        self.listener = Listener(("localhost", 0), authkey=b"test key")
+        self.serving = threading.Thread(target=wlogdb.serve_writes, args=(self.listener,), daemon=True)
+        self.serving.start()
+        wlogdb.connect_to_writer(self.listener.address, b"test key")
+
+    def tearDown(self):
+        wlogdb.disconnect_from_writer()
+        self.listener.close()
+        wlogdb.stop_task_writer()
+        super().tearDown()
+
+    def test_writes_go_through_the_served_writer(self):
+        task_id = wlogdb.write("create", dict(task_1_user_name="client", task_0_name="task",
+                                              task_3_duration=1, task_4_notes="notes"))
+        wlogdb.write("tombstone", task_id, datetime.now())
+        task = wlogdb.Task.get(wlogdb.Task.id == task_id)
+        self.assertEqual(task.task_1_user_name, "client")
+        self.assertIsNotNone(task.task_5_deleted_at)
+
+    def test_failing_write_raises_in_the_client(self):
+        with self.assertRaises(IntegrityError):
+            wlogdb.write("create", dict(task_1_user_name=None, task_0_name="no user",
+                                        task_3_duration=1, task_4_notes="notes"))
+
+    def test_memory_sessions_do_not_connect(self):
+        wlogdb.disconnect_from_writer()
+        for storage in ("memory", "preload"):
+            wlogdb.configure_database(os.path.join(self.directory.name, "test.db"), storage=storage,
+                                      write_back=False)
+            with self.assertRaises(ValueError):
+                wlogdb.connect_to_writer(self.listener.address, b"test key")
+            self.assertIsNone(wlogdb.writer_connection)
+
+    def test_stray_connections_do_not_stop_serving(self):
+        wlogdb.disconnect_from_writer()
+        for _ in range(3):
+            socket.create_connection(self.listener.address).close()
+        time.sleep(0.2)
+        self.assertTrue(self.serving.is_alive())
+        wlogdb.connect_to_writer(self.listener.address, b"test key")
+        task_id = wlogdb.write("create", dict(task_1_user_name="client", task_0_name="after a scan",
+                                              task_3_duration=1, task_4_notes="notes"))
+        self.assertTrue(wlogdb.Task.select().where(wlogdb.Task.id == task_id).exists())
+
+    def test_wrong_key_is_refused(self):
+        with self.assertRaises(AuthenticationError):
+            Client(self.listener.address, authkey=b"wrong key")
+
+
 class BadRawTaskDate(unittest.TestCase):
     @unittest.expectedFailure
     def test_pipo(self):
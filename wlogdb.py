@@ -16,18 +16,42 @@ by Miguel de Luis
 
 # imports
 
+import argparse
+import atexit
+import csv
+import hashlib
 import logging
-from collections import OrderedDict
-from datetime import date
-from sys import stdin, exit
+import os
+import queue
+import re
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta
+from multiprocessing import AuthenticationError, Pool
+from multiprocessing.connection import Client, Listener
+from sys import stdin, stdout, exit
+from time import perf_counter
+from urllib.request import pathname2url
 
 from blessings import Terminal
 from peewee import *
+from playhouse.migrate import SqliteMigrator, migrate
 
 # constants
 
 DATE_FORMAT = "%d/%m/%Y"
+DEFAULT_DATABASE_PATH = "work_log.db"
+STORAGE_MODES = ("file", "memory", "preload")
 STANDARD_FIELD_LENGTH = 255
+UNDO_WINDOW = timedelta(minutes=30)  # deleted tasks can be restored for this long, then purged on maintenance
+PURGE_BATCH_SIZE = 500
+GROUP_COMMIT_SIZE = 256  # most writes the task writer puts in one transaction
+GROUP_COMMIT_WAIT = 0.005  # longest, in seconds, the task writer spends gathering a batch
+DEFAULT_SCREEN_SIZE = (24, 80)  # height, width; used when the terminal can't tell us
+TABLE_CHROME_LINES = 9  # title, headers, footer and prompt lines around a table page
+DEFAULT_WRITER_ADDRESS = "localhost:6543"
 
 # Globals
 
@@ -36,7 +60,13 @@ term = Terminal()
 logging.basicConfig(filename='log.log', level=logging.DEBUG,
                     format='%(asctime)s %(message)s', datefmt='%d/%m/%Y %I:%M:%S %p')
 
-db = SqliteDatabase("work_log.db")
+db = SqliteDatabase(None)  # set up at runtime by configure_database
+write_back_path = None  # file a preloaded database is copied back to on exit
+write_back_state = None  # state of that file when it was preloaded, see database_file_state
+deleted_this_session = []  # ids of the tasks this session deleted, oldest first, see undo_delete
+task_writer = None  # group commit writer, writes go through it while it runs
+writer_connection = None  # connection to a task writer served by another process, see serve_writes
+writer_connection_lock = threading.Lock()
 
 # Classes
 
@@ -48,13 +78,237 @@ class Task(Model):
     task_3_duration = IntegerField(help_text="Time spent on the task, in minutes")
     task_2_date = DateField(default=date.today)
     task_4_notes = TextField()
+    task_5_deleted_at = DateTimeField(null=True, help_text="Tombstone, set when the task is deleted")
 
     class Meta:
         database = db
 
+
+class TaskWriter:
+    """
+    Single writer for many concurrent clients: writes are queued and a writer thread runs them in batches,
+    one transaction per batch, so that clients share the write lock and the fsync instead of queueing for them
+    Each write runs in its own savepoint, a failing write doesn't take the rest of its batch down
+    The writer thread has its own connection, so it works with file databases, not in-memory ones
+    Threads submit writes directly, other processes through "wlogdb.py serve", see serve_writes
+    """
+
+    def __init__(self, max_batch: int = GROUP_COMMIT_SIZE, max_wait: float = GROUP_COMMIT_WAIT):
+        """
+        :param max_batch: int, most writes per transaction
+        :param max_wait: float, longest time in seconds spent gathering a batch
+        """
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.writes = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name="task writer", daemon=True)
+        self.stopped = False
+        self.lock = threading.Lock()  # nothing gets queued behind the stop sentinel
+
+    def start(self):
+        """
+        :return: TaskWriter
+        """
+        if db.database == ":memory:":
+            raise ValueError("The task writer has its own connection, it can't run on an in-memory database")
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Commits the writes already queued and stops the writer thread, later writes are refused
+        :return: None
+        """
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.writes.put(None)
+        self.thread.join()
+
+    def submit(self, operation, *args, **kwargs):
+        """
+        Queues a write and waits until it is committed
+        :param operation: function doing the write, e.g. Task.create
+        :return: whatever operation returns, or raises what it raised
+        """
+        future = Future()
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError("The task writer has been stopped")
+            self.writes.put((future, operation, args, kwargs))
+        return future.result()
+
+    def run(self):
+        """
+        Writer thread: takes a batch of writes, commits it, acknowledges its writers, repeat until stopped
+        :return: None
+        """
+        stopping = False
+        while not stopping:
+            write = self.writes.get()
+            if write is None:
+                break
+            batch = [write]
+            deadline = perf_counter() + self.max_wait
+            # no idle waiting: the batch is what queued up while the last one was committing
+            while len(batch) < self.max_batch and not self.writes.empty() and perf_counter() < deadline:
+                try:
+                    write = self.writes.get_nowait()
+                except queue.Empty:
+                    break
+                if write is None:
+                    stopping = True
+                    break
+                batch.append(write)
+            self.commit(batch)
+        db.close()
+
+    @staticmethod
+    def commit(batch: list):
+        """
+        Runs a batch of writes in one transaction, then acknowledges each writer
+        :param batch: [(Future, function, tuple, dict)]
+        :return: None
+        """
+        outcomes = []
+        try:
+            with db.atomic():
+                for future, operation, args, kwargs in batch:
+                    try:
+                        with db.atomic():
+                            outcomes.append((future, operation(*args, **kwargs), None))
+                    except Exception as error:
+                        outcomes.append((future, None, error))
+        except Exception as error:
+            logging.error("Task writer could not commit {} writes: {}".format(len(batch), error))
+            for future, operation, args, kwargs in batch:
+                future.set_exception(error)
+            return
+
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+# Lightweight, read only task; namedtuples have no per instance __dict__
+TaskRecord = namedtuple("TaskRecord", ["id", "task_00_project", "task_0_name", "task_1_user_name",
+                                       "task_2_date", "task_3_duration", "task_4_notes"])
+
+
+def live_tasks():
+    """
+    Base query for every search, leaves out tasks that have been (soft) deleted
+    :return: SelectQuery
+    """
+    return Task.select().where(Task.task_5_deleted_at.is_null())
+
+
+def read_records(tasks):
+    """
+    Fast read path for large scans: iterates any task query as TaskRecords instead of Task models
+    Rows are streamed, not cached by the query; sqlite3 keeps the statement prepared between runs
+    :param tasks: SelectQuery, as returned by the search functions
+    :return: iterator of TaskRecord
+    """
+    columns = [getattr(Task, field) for field in TaskRecord._fields]
+    return map(TaskRecord._make, tasks.select(*columns).tuples().iterator())
+
+
 # Helper Functions
 
 
+def configure_database(path: str = None, storage: str = None, write_back: bool = True):
+    """
+    Selects the database to work with, path and storage default to the WORKLOG_DB and WORKLOG_STORAGE
+    environment variables, or to work_log.db on file
+    file: work on the file at path
+    memory: work on an empty in-memory database, path is ignored
+    preload: copy the file at path into memory and work there, copying it back on exit if write_back
+    and nobody else changed the file in between
+    :param path: str
+    :param storage: str, one of STORAGE_MODES
+    :param write_back: bool, only used by preload
+    :return: None
+    """
+    global write_back_path, write_back_state
+
+    path = path or os.environ.get("WORKLOG_DB", DEFAULT_DATABASE_PATH)
+    storage = storage or os.environ.get("WORKLOG_STORAGE", "file")
+    if path == ":memory:":
+        storage = "memory"
+    if storage not in STORAGE_MODES:
+        raise ValueError("Unknown storage {}, use one of {}".format(storage, ", ".join(STORAGE_MODES)))
+
+    if not db.is_closed():
+        db.close()
+    write_back_path = None
+
+    if storage == "file":
+        db.init(path)
+    else:
+        # an in-memory database lives as long as its connection, so it is opened here and kept open
+        db.init(":memory:")
+        db.connect()
+        if storage == "preload":
+            source = sqlite3.connect(path)
+            source.backup(db.connection())
+            source.close()
+            if write_back:
+                write_back_path = path
+                write_back_state = database_file_state(path)
+    logging.info("Using {} database {}".format(storage, path))
+
+
+def database_file_state(path: str):
+    """
+    Something that changes whenever the database file does: its modification time, size and
+    the change counter sqlite bumps on every commit (bytes 24 to 27 of the header)
+    :param path: str
+    :return: tuple, or None if there's no such file
+    """
+    try:
+        file_stat = os.stat(path)
+        with open(path, "rb") as database_file:
+            database_file.seek(24)
+            change_counter = database_file.read(4)
+    except FileNotFoundError:
+        return None
+    return file_stat.st_mtime_ns, file_stat.st_size, change_counter
+
+
+@atexit.register
+def write_back_database():
+    """
+    Copies a preloaded database back to its file
+    If the file changed since it was preloaded, another session wrote to it: rather than wiping those writes,
+    this session is saved next to it
+    :return: str, the file written to, or None
+    """
+    global write_back_state
+
+    if not write_back_path or db.is_closed():
+        return None
+
+    destination_path = write_back_path
+    if database_file_state(write_back_path) != write_back_state:
+        destination_path = "{}.{}.unsaved".format(write_back_path, datetime.now().strftime("%Y%m%d%H%M%S"))
+        message = "{} changed since it was preloaded, this session was saved to {} instead".format(
+            write_back_path, destination_path)
+        logging.warning(message)
+        print(term.bold(message))
+
+    destination = sqlite3.connect(destination_path)
+    db.connection().backup(destination)
+    destination.close()
+    if destination_path == write_back_path:
+        write_back_state = database_file_state(write_back_path)
+    logging.info("Database written back to {}".format(destination_path))
+    return destination_path
+
+
 def show_help_message(message: str) -> int:
     """
     Print x if there's an x to print
@@ -68,6 +322,65 @@ def show_help_message(message: str) -> int:
         return 0
 
 
+def screen_size() -> tuple:
+    """
+    :return: (int, int) terminal height and width
+    """
+    return term.height or DEFAULT_SCREEN_SIZE[0], term.width or DEFAULT_SCREEN_SIZE[1]
+
+
+def rows_per_page() -> int:
+    """
+    How many table rows fit on the screen
+    :return: int
+    """
+    return max(screen_size()[0] - TABLE_CHROME_LINES, 1)
+
+
+def page_count(total_rows: int) -> int:
+    """
+    :param total_rows: int
+    :return: int, number of table pages needed, at least 1
+    """
+    return max(-(-total_rows // rows_per_page()), 1)
+
+
+def render_table(title: str, headers: list, rows: list, page: int, total_pages: int) -> str:
+    """
+    Renders one page of a table as a single string, lines are cut to the terminal width
+    :param title: str
+    :param headers: [str]
+    :param rows: [[object]] only the rows of the page to render
+    :param page: int, zero based
+    :param total_pages: int
+    :return: str
+    """
+    width = screen_size()[1]
+    first_number = page * rows_per_page() + 1
+    cells = [[str(first_number + i)] + [str(cell).replace("\n", " ") for cell in row] for i, row in enumerate(rows)]
+    headers = ["#"] + list(headers)
+    widths = [max([len(header)] + [len(row[column]) for row in cells]) for column, header in enumerate(headers)]
+
+    def table_line(row):
+        return "  ".join(cell.ljust(widths[column]) for column, cell in enumerate(row))[:width]
+
+    lines = [term.clear + term.bold_underline(title[:width]), "",
+             term.bold(table_line(headers)), table_line(["-" * w for w in widths])]
+    lines += [table_line(row) for row in cells]
+    lines += ["", "Page {} of {}\t(n)ext page\t(p)revious page".format(page + 1, total_pages)[:width]]
+    return "\n".join(lines)
+
+
+def write_screen(text: str):
+    """
+    Writes a whole screen at once, instead of line by line
+    :param text: str
+    :return: None
+    """
+    stdout.write(text + "\n")
+    stdout.flush()
+
+
 def input_task_date(prompt: str, help_message: str = "") -> date:
     """
     Manages the user input of task dates, allows various formats, defaults to date.today()
@@ -238,6 +551,172 @@ def input_task_data():
     return project, name_of_user, name_of_task, duration_of_task, notes, date_entered
 
 
+def start_task_writer(max_batch: int = GROUP_COMMIT_SIZE, max_wait: float = GROUP_COMMIT_WAIT):
+    """
+    Starts the group commit writer, from then on writes go through it
+    :param max_batch: int
+    :param max_wait: float
+    :return: TaskWriter
+    """
+    global task_writer
+    task_writer = TaskWriter(max_batch, max_wait).start()
+    return task_writer
+
+
+def stop_task_writer():
+    """
+    Commits pending writes and goes back to writing straight to the database
+    :return: None
+    """
+    global task_writer
+    if task_writer is not None:
+        task_writer.stop()
+        task_writer = None
+
+
+def create_task_row(fields: dict) -> int:
+    """
+    :param fields: dict, Task field names and values
+    :return: int, id of the new task
+    """
+    return Task.create(**fields).id
+
+
+def update_task_row(task_id: int, fields: dict) -> int:
+    """
+    :param task_id: int
+    :param fields: dict, Task field names and values
+    :return: int, number of tasks updated
+    """
+    return Task.update(**fields).where(Task.id == task_id).execute()
+
+
+def set_task_tombstone(task_id: int, deleted_at) -> int:
+    """
+    :param task_id: int
+    :param deleted_at: datetime, or None to restore the task
+    :return: int, number of tasks updated
+    """
+    return Task.update(task_5_deleted_at=deleted_at).where(Task.id == task_id).execute()
+
+
+# Writes are named and take plain data, so that other processes can send them to a served task writer
+WRITE_OPERATIONS = dict(create=create_task_row, update=update_task_row, tombstone=set_task_tombstone)
+
+
+def write(operation: str, *args):
+    """
+    Runs a write through the task writer: the one served by another process when connected to it,
+    the one in this process when it is running, or straight away otherwise
+    :param operation: str, one of WRITE_OPERATIONS
+    :return: whatever the operation returns
+    """
+    if writer_connection is not None:
+        with writer_connection_lock:
+            writer_connection.send((operation, args))
+            committed, result = writer_connection.recv()
+        if not committed:
+            raise result
+        return result
+    if task_writer is not None:
+        return task_writer.submit(WRITE_OPERATIONS[operation], *args)
+    return WRITE_OPERATIONS[operation](*args)
+
+
+def parse_writer_address(address: str) -> tuple:
+    """
+    :param address: str, as host:port
+    :return: (str, int)
+    """
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def serve_writes(listener: Listener):
+    """
+    Accepts connections from other work log processes and passes their writes on to the task writer,
+    until the listener is closed
+    :param listener: Listener
+    :return: None
+    """
+    while True:
+        try:
+            connection = listener.accept()
+        except (AuthenticationError, EOFError, OSError) as error:
+            if listener._listener is None:  # Listener.close() clears it, that's the only way out
+                return
+            # wrong key, or a connection dropped during the handshake: a port scan, a killed client...
+            logging.info("Task writer refused a connection: {!r}".format(error))
+            continue
+        threading.Thread(target=serve_writer_client, args=(connection,), daemon=True).start()
+
+
+def serve_writer_client(connection):
+    """
+    Runs the writes of one client process, answering (True, result) or (False, exception) to each one
+    :param connection: Connection
+    :return: None
+    """
+    with connection:
+        while True:
+            try:
+                operation, args = connection.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                answer = (True, task_writer.submit(WRITE_OPERATIONS[operation], *args))
+            except Exception as error:
+                answer = (False, error)
+            try:
+                connection.send(answer)
+            except OSError:
+                return
+
+
+def connect_to_writer(address: tuple, authkey: bytes):
+    """
+    From now on writes go to the task writer served at address
+    The session has to work on the database file itself: an in-memory copy would miss the writes committed
+    by the writer, and a preloaded one would overwrite them on exit
+    :param address: (str, int)
+    :param authkey: bytes
+    :return: None
+    """
+    global writer_connection
+    if db.database == ":memory:":
+        raise ValueError("Sessions using a task writer have to work on the database file, not in memory")
+    writer_connection = Client(address, authkey=authkey)
+
+
+def disconnect_from_writer():
+    """
+    :return: None
+    """
+    global writer_connection
+    if writer_connection is not None:
+        writer_connection.close()
+        writer_connection = None
+
+
+def serve_task_writer(address: str, authkey: bytes):
+    """
+    Runs the task writer for other work log processes until interrupted
+    :param address: str, as host:port
+    :param authkey: bytes
+    :return: None
+    """
+    start_task_writer()
+    listener = Listener(parse_writer_address(address), authkey=authkey)
+    print("Task writer serving on {}, ctrl+c to stop".format(address))
+    try:
+        serve_writes(listener)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        stop_task_writer()
+
+
 def add_task():
     """
     Creates a new task, based on user input
@@ -245,16 +724,38 @@ def add_task():
     """
     project, name_of_user, name_of_task, duration_of_task, notes, date_entered = input_task_data()
 
-    Task.create(task_00_project=project, task_1_user_name=name_of_user, task_0_name=name_of_task,
-                task_3_duration=duration_of_task, task_4_notes=notes, task_2_date=date_entered)
+    write("create", dict(task_00_project=project, task_1_user_name=name_of_user, task_0_name=name_of_task,
+                         task_3_duration=duration_of_task, task_4_notes=notes, task_2_date=date_entered))
 
 
 def initialize():
     """
     :return: None
     """
-    db.connect()
+    if db.deferred:
+        configure_database()
+    if db.is_closed():
+        db.connect()
     db.create_tables([Task], safe=True)
+    if "task_5_deleted_at" not in [column.name for column in db.get_columns("task")]:
+        # databases created before soft deletes need the tombstone column
+        migrate(SqliteMigrator(db).add_column("task", "task_5_deleted_at", Task.task_5_deleted_at))
+    # searches only ever look at live tasks, so index just those
+    db.execute_sql("CREATE INDEX IF NOT EXISTS task_live_date ON task (task_2_date) "
+                   "WHERE task_5_deleted_at IS NULL")
+
+
+def task_at(tasks, ti):
+    """
+    Fetches the task at index ti of a query on its own, tasks[ti] would build every task of the query
+    :param tasks: SelectQuery
+    :param ti: int task index
+    :return: Task, raises Task.DoesNotExist past the end
+    """
+    task = tasks.offset(ti).limit(1).first()  # not get(), it would reset the offset
+    if task is None:
+        raise Task.DoesNotExist("No task at index {}".format(ti))
+    return task
 
 
 def next_task(ti, tasks):
@@ -263,7 +764,7 @@ def next_task(ti, tasks):
     :param ti: int task index
     :return: int
     """
-    if ti < len(tasks) - 1:
+    if ti < tasks.count() - 1:
         return ti + 1
     else:
         print("\a No more tasks to show")
@@ -302,16 +803,12 @@ def edit_task(ti, tasks):
     """
     project, name_of_user, name_of_task, duration_of_task, notes, edited_date = input_task_data()
     # edited_date avoids shadowing date
-    tasks[ti].task_00_project = project
-    tasks[ti].task_1_user_name = name_of_user
-    tasks[ti].task_0_name = name_of_task
-    tasks[ti].task_3_duration = duration_of_task
-    tasks[ti].task_4_notes = notes
-    tasks[ti].task_2_date = edited_date
+    fields = dict(task_00_project=project, task_1_user_name=name_of_user, task_0_name=name_of_task,
+                  task_3_duration=duration_of_task, task_4_notes=notes, task_2_date=edited_date)
 
     user_confirm = input("Confirm edit y/N").strip().lower()
     if user_confirm == "y":
-        tasks[ti].save()
+        write("update", task_at(tasks, ti).id, fields)
         print("Task edited")
     else:
         print("Nothing changed")
@@ -327,14 +824,132 @@ def delete_task(ti, tasks):
     """
     user_confirms = input("Please confirm you want to delete this task y/N").strip().lower()
     if user_confirms == "y":
-        tasks[ti].delete_instance()
-        logging.info("Task {} deleted".format(tasks[ti].task_0_name))
+        task = task_at(tasks, ti)
+        soft_delete_task(task)
+        logging.info("Task {} deleted".format(task.task_0_name))
+        print("Task deleted, you may undo it from the main menu within {} minutes".format(
+            int(UNDO_WINDOW.total_seconds() // 60)))
 
         return -1
     else:
         return ti
 
 
+def soft_delete_task(task):
+    """
+    Marks a task as deleted, it stays in the database until purged by maintain_database
+    :param task: Task
+    :return: None
+    """
+    task.task_5_deleted_at = datetime.now()
+    write("tombstone", task.id, task.task_5_deleted_at)
+    deleted_this_session.append(task.id)
+
+
+def undo_delete():
+    """
+    Restores the task this session deleted last, if it was deleted within the undo window
+    Only this session's deletes are undone, the database is shared and others' deletes are theirs to undo
+    :return: Task or None
+    """
+    while deleted_this_session:
+        task_id = deleted_this_session.pop()
+        try:
+            task = (Task.select()
+                    .where((Task.id == task_id) &
+                           (Task.task_5_deleted_at >= datetime.now() - UNDO_WINDOW))
+                    .get())
+            break
+        except Task.DoesNotExist:
+            # out of the undo window, purged or already restored elsewhere
+            continue
+    else:
+        return None
+
+    task.task_5_deleted_at = None
+    write("tombstone", task.id, None)
+    logging.info("Task {} restored".format(task.task_0_name))
+    return task
+
+
+def show_undo_delete():
+    """
+    Runs undo_delete and shows what it did
+    :return: None
+    """
+    task = undo_delete()
+    if task:
+        print("Task \"{}\" restored".format(task.task_0_name))
+    else:
+        print("Nothing to undo")
+    input("Press enter to continue")
+
+
+def purge_deleted_tasks(batch_size=PURGE_BATCH_SIZE):
+    """
+    Removes for good tasks deleted before the undo window, batch by batch to keep write locks short
+    :param batch_size: int
+    :return: int, number of tasks purged
+    """
+    cutoff = datetime.now() - UNDO_WINDOW
+    purged = 0
+    while True:
+        batch = (Task.select(Task.id)
+                 .where(Task.task_5_deleted_at < cutoff)
+                 .limit(batch_size))
+        with db.atomic():
+            deleted = Task.delete().where(Task.id.in_(batch)).execute()
+        purged += deleted
+        if deleted < batch_size:
+            return purged
+
+
+def database_size():
+    """
+    :return: int, size in bytes of the database file
+    """
+    page_count = db.execute_sql("PRAGMA page_count").fetchone()[0]
+    page_size = db.execute_sql("PRAGMA page_size").fetchone()[0]
+    return page_count * page_size
+
+
+def maintain_database():
+    """
+    Purges old tombstones, gives the free pages back to the file system and refreshes the query planner stats
+    :return: dict with the maintenance report
+    """
+    size_before = database_size()
+    purged = purge_deleted_tasks()
+
+    if db.execute_sql("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # auto_vacuum can only be switched to incremental by a full VACUUM, that's a one off
+        db.execute_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        db.execute_sql("VACUUM")
+    else:
+        # incremental_vacuum frees one page per step and the sqlite3 cursor steps only once,
+        # executescript runs it to the end
+        db.connection().executescript("PRAGMA incremental_vacuum")
+    db.execute_sql("ANALYZE")
+
+    size_after = database_size()
+    report = dict(purged=purged, size_before=size_before, size_after=size_after,
+                  reclaimed=size_before - size_after)
+    logging.info("Maintenance: {purged} tasks purged, {reclaimed} bytes reclaimed".format(**report))
+    return report
+
+
+def show_maintenance_report():
+    """
+    Runs maintain_database and shows what it did
+    :return: None
+    """
+    report = maintain_database()
+    print(term.bold("Maintenance done"))
+    print("Tasks purged: {purged}\nSize before: {size_before} bytes\nSize after: {size_after} bytes\n"
+          "Reclaimed: {reclaimed} bytes".format(**report))
+    input("Press enter to continue")
+
+
 def view_entries(
         tasks,
         fields_to_hide=set([]),
@@ -343,8 +958,9 @@ def view_entries(
     """
     Show filtered tasks, task by task, allows navigation, also acts as menu to edit and delete tasks
 
-    OK Ducky, First thing we call show_task_and_menu to show us the first task and a sub menu
-    That sub menu has choices for next, previous, edit, delete task and exit view entries
+    OK Ducky, First thing we call show_table to show a page of tasks, the user picks one by its number
+    Then show_task_and_menu shows us that task and a sub menu
+    That sub menu has choices for next, previous, edit, delete task, back to the table and exit view entries
     We ask the user nicely for a choice, passing around the task index
     If the user wants to exit we pass -1
 
@@ -358,7 +974,7 @@ def view_entries(
     fields_to_show = sorted(list(fields - fields_to_hide))
 
     def input_choice(choices,
-                     menu_prompt="(p)revious\t(n)ext\n(d)elete\t(e)dit\ne(x)it", help_message=""):
+                     menu_prompt="(p)revious\t(n)ext\n(d)elete\t(e)dit\n(t)able\te(x)it", help_message=""):
         """
         Handles the sub-menu
         :param menu_prompt: string
@@ -375,7 +991,7 @@ def view_entries(
             logging.info("choice in choice keys")
             return choice
         else:
-            return input_choice(choices=choices, help_message="\aValid choices: p,n,x")
+            return input_choice(choices=choices, help_message="\aValid choices: p,n,d,e,t,x")
 
     def show_task_and_menu(ti=0):
         """
@@ -387,12 +1003,13 @@ def view_entries(
         :return: None
         """
 
-        choices = {"n": next_task, "p": previous_task, "x": exit_view, "d": delete_task, "e": edit_task}
+        choices = {"n": next_task, "p": previous_task, "x": exit_view, "d": delete_task, "e": edit_task,
+                   "t": show_table}
         # choices a dictionary with the show menu choices
         try:
-            show_task(task=tasks[ti], total_tasks=len(tasks), task_number=ti + 1)
-        except IndexError:
-            logging.ERROR("Index Error on show_task_and_menu, perhaps no tasks on the database")
+            show_task(task=task_at(tasks, ti), total_tasks=tasks.count(), task_number=ti + 1)
+        except Task.DoesNotExist:
+            logging.error("Index Error on show_task_and_menu, perhaps no tasks on the database")
             print("You may want to add a task first")
             return None
 
@@ -422,68 +1039,104 @@ def view_entries(
 
         print("Task {} of {}\n".format(task_number, total_tasks))
         for fts in fields_to_show:
-            field = task.__dict__['_data'][fts]
+            field = getattr(task, fts)
             if fts == "task_2_date":
                 field = field.strftime(DATE_FORMAT)
             if field:
                 print("{}: {}".format(term.bold(print_tags[fts]), field))
         print()
 
-    show_task_and_menu()
+    def show_table(ti, tasks, help_message=""):
+        """
+        Shows the page of the tasks table where task ti is, one screen at a time
+        :param ti: int task index
+        :param tasks: Tasks
+        :param help_message: string
+        :return: int, index of the task chosen by the user or -2 to exit
+        """
+        table_tags = dict(task_00_project="Project", task_0_name="Description", task_1_user_name="User",
+                          task_2_date="Date", task_3_duration="Minutes", task_4_notes="Notes")
+        size = rows_per_page()
+        total_tasks = tasks.count()  # counted by sqlite, no Task is built for the rows off screen
+        total_pages = page_count(total_tasks)
+        page = min(ti // size, total_pages - 1)
+
+        rows = []
+        for task in tasks.paginate(page + 1, size):
+            row = []
+            for fts in fields_to_show:
+                field = getattr(task, fts)
+                row.append(field.strftime(DATE_FORMAT) if fts == "task_2_date" else field)
+            rows.append(row)
+
+        write_screen(render_table(title, [table_tags[fts] for fts in fields_to_show], rows, page, total_pages))
+        show_help_message(help_message)
+        choice = input(term.bold("Task number to view, (n)ext page, (p)revious page, e(x)it: ")).strip().lower()
+
+        if choice == "n":
+            return show_table(min(page + 1, total_pages - 1) * size, tasks)
+        elif choice == "p":
+            return show_table(max(page - 1, 0) * size, tasks)
+        elif choice == "x":
+            return exit_view(ti, tasks)
+        elif choice.isdigit() and 0 < int(choice) <= total_tasks:
+            return int(choice) - 1
+        else:
+            return show_table(ti, tasks, help_message="Valid choices: a task number, n, p, x")
+
+    ti = show_table(0, tasks)
+    if ti >= 0:
+        show_task_and_menu(ti)
 
 
 def get_tasks_by_date():
     try:
-        return Task.select().order_by(Task.task_2_date)
+        return live_tasks().order_by(Task.task_2_date)
     except OperationalError:
         logging.ERROR("Operational Error on get_tasks_by_date")
         return None
 
 
-def show_dates_with_tasks():
+def show_dates_with_tasks(page: int = 0):
     """
-    Shows a lists of dates that have tasks, and the number of tasks on each date
+    Shows a page of the list of dates that have tasks, and the number of tasks on each date
+    :param page: int, zero based page of the list to show
     :return: [string] list_of_dates
     """
 
     tasks = get_tasks_by_date()
 
-    if tasks:
-        def pretty_dates(x):
-            return x.task_2_date.strftime(DATE_FORMAT)
-
-        all_dates = list(map(pretty_dates, tasks))
-        list_of_dates = []
-        tasks_in_dates = {}
-
-        for date_item in all_dates:
-            if date_item not in list_of_dates:
-                list_of_dates.append(date_item)
-                tasks_in_dates[date_item] = 1
-            else:
-                tasks_in_dates[date_item] += 1
-
-        print(term.clear)
-        print(term.bold("\n\tDates with Task --- Number of Dates\n"))
-        i = 1
-        for date_item in list_of_dates:
-            print("\t{}.- {}\t--- {}".format(term.bold(str(i)), date_item, tasks_in_dates[date_item]))
-            i += 1
+    if tasks is not None and tasks.exists():  # len() would build every task
+        dates_and_counts = (tasks.select(Task.task_2_date, fn.COUNT(Task.id))
+                            .group_by(Task.task_2_date)
+                            .tuples())
+        rows = [(date_item.strftime(DATE_FORMAT), count) for date_item, count in dates_and_counts]
+        list_of_dates = [date_item for date_item, count in rows]
+
+        size = rows_per_page()
+        total_pages = page_count(len(rows))
+        page = min(max(page, 0), total_pages - 1)
+        write_screen(render_table("Dates with Tasks", ["Date", "Number of Tasks"],
+                                  rows[page * size:(page + 1) * size], page, total_pages))
         return list_of_dates
     else:
         return None
 
 
-def safe_date_choice_input(list_of_dates: list, validation_message: str = "") -> date:
+def safe_date_choice_input(list_of_dates: list, validation_message: str = "", page: int = 0) -> date:
     """
     manages input to safely choose a date among those which have tasks
     :param list_of_dates: [str]
     :param validation_message: str
+    :param page: int, page of the dates list on screen
     :return: date
     """
     show_help_message(validation_message)
 
-    raw_input = input("\nEnter date to look for: ")
+    raw_input = input("\nEnter date to look for, (n)ext page, (p)revious page: ").strip().lower()
+    if raw_input in ("n", "p"):
+        page = min(max(page + (1 if raw_input == "n" else -1), 0), page_count(len(list_of_dates)) - 1)
+        return safe_date_choice_input(show_dates_with_tasks(page), page=page)
     try:
         date_entered = list_of_dates[int(raw_input) - 1]
         day, month, year = date_entered.split("/")
@@ -491,11 +1144,13 @@ def safe_date_choice_input(list_of_dates: list, validation_message: str = "") ->
     except IndexError:
         logging.info("User entered a number not in the dates list on safe_date_choice_input")
         return safe_date_choice_input(list_of_dates,
-                                      validation_message="That number does not correspond to any date.")
+                                      validation_message="That number does not correspond to any date.",
+                                      page=page)
     except ValueError:
         logging.info("User entered something other than a number in the dates list on safe_date_choice_input")
         return safe_date_choice_input(list_of_dates,
-                                      validation_message="Choose any of the dates using its ordinal number.")
+                                      validation_message="Choose any of the dates using its ordinal number.",
+                                      page=page)
 
 
 def search_entries_by_date():
@@ -511,7 +1166,7 @@ def search_entries_by_date():
 
         date_to_search = safe_date_choice_input(list_of_dates)
 
-        tasks = Task.select().where(Task.task_2_date == date_to_search)
+        tasks = live_tasks().where(Task.task_2_date == date_to_search).order_by(Task.id)
 
         view_entries(tasks,
                      title="Tasks completed on {}".format(date_to_search.strftime(DATE_FORMAT)),
@@ -529,15 +1184,18 @@ def get_filtered_tasks(term_filter, attribute_to_filter=None):
     :return: [task] or None
     """
     try:
-        all_tasks = Task.select()
+        all_tasks = live_tasks()
     except OperationalError:
         return None
 
+    # a fixed order, so that table pages and task_at agree on which task is which
+    all_tasks = all_tasks.order_by(Task.task_2_date, Task.id)
+
     try:
         if attribute_to_filter:
             return all_tasks.where(attribute_to_filter == term_filter)
         else:
-            return Task.select().where(
+            return all_tasks.where(
                 (Task.task_0_name.contains(term_filter)) |
                 (Task.task_4_notes.contains(term_filter))
             )
@@ -555,7 +1213,7 @@ def search_entries_by_employee():
     employee = input("Employee name:").strip()
 
     tasks = get_filtered_tasks(employee, Task.task_1_user_name)
-    if tasks:
+    if tasks is not None and tasks.exists():
         view_entries(tasks,
                      title="Tasks completed by {}".format(employee),
                      fields_to_hide={"task_1_user_name"})
@@ -573,7 +1231,7 @@ def find_by_search_term():
 
     tasks = get_filtered_tasks(term_filter=search_term)
 
-    if tasks:
+    if tasks is not None and tasks.exists():
         view_entries(tasks,
                      title="Tasks that contain \"{}\"".format(search_term))
     else:
@@ -589,7 +1247,7 @@ def search_by_project():
 
     tasks = get_filtered_tasks(term_filter=project_to_search, attribute_to_filter=Task.task_00_project)
 
-    if tasks:
+    if tasks is not None and tasks.exists():
         view_entries(tasks,
                      title="Tasks that belong to \"{}\"".format(project_to_search))
     else:
@@ -639,22 +1297,170 @@ def menu_loop(menu):
             menu[choice][0]()
 
 
+def month_range(month: str) -> tuple:
+    """
+    :param month: str, as yyyy-mm
+    :return: (date, date) first day of the month and first day of the next one
+    """
+    first_day = datetime.strptime(month, "%Y-%m").date()
+    if first_day.month == 12:
+        return first_day, date(first_day.year + 1, 1, 1)
+    return first_day, date(first_day.year, first_day.month + 1, 1)
+
+
+def employees_with_tasks(first_day: date, next_month: date) -> list:
+    """
+    :param first_day: date
+    :param next_month: date
+    :return: [str] names of the users with tasks between both dates
+    """
+    users = (live_tasks()
+             .select(Task.task_1_user_name)
+             .where((Task.task_2_date >= first_day) & (Task.task_2_date < next_month))
+             .distinct()
+             .order_by(Task.task_1_user_name)
+             .tuples())
+    return [user for (user,) in users]
+
+
+def open_read_only_database(path: str):
+    """
+    Report worker initializer, every worker process gets its own read only connection, open for its lifetime
+    :param path: str
+    :return: None
+    """
+    db.init("file:{}?mode=ro".format(pathname2url(os.path.abspath(path))), uri=True)
+    db.connect()
+
+
+def write_employee_report(job: tuple) -> tuple:
+    """
+    Writes the timesheet of one employee for one month as csv, runs on a report worker
+    :param job: (str, date, date, str) user name, first day, first day of next month, output directory
+    :return: (str, str, int, int) user name, report path, number of tasks, total minutes
+    """
+    user, first_day, next_month, output_dir = job
+    tasks = (live_tasks()
+             .where((Task.task_1_user_name == user) &
+                    (Task.task_2_date >= first_day) & (Task.task_2_date < next_month))
+             .order_by(Task.task_2_date, Task.id))
+    # a short hash of the raw name keeps users whose names clean up the same apart
+    path = os.path.join(output_dir, "{}_{}_{}.csv".format(first_day.strftime("%Y-%m"),
+                                                          re.sub(r"[^\w-]+", "_", user),
+                                                          hashlib.sha1(user.encode()).hexdigest()[:8]))
+    number_of_tasks = total_minutes = 0
+
+    with open(path, "w", newline="") as report:
+        writer = csv.writer(report)
+        writer.writerow(["Date", "Project", "Task", "Minutes", "Notes"])
+        for task in read_records(tasks):
+            writer.writerow([task.task_2_date.strftime(DATE_FORMAT), task.task_00_project, task.task_0_name,
+                             task.task_3_duration, task.task_4_notes.strip()])
+            number_of_tasks += 1
+            total_minutes += task.task_3_duration
+        writer.writerow(["Total", "", "", total_minutes, ""])
+
+    return user, path, number_of_tasks, total_minutes
+
+
+def per_employee_reports(month: str, output_dir: str, workers: int = None) -> list:
+    """
+    Writes one timesheet per employee with tasks in the month, spread over a pool of worker processes
+    :param month: str, as yyyy-mm
+    :param output_dir: str
+    :param workers: int, number of processes, defaults to the number of CPUs
+    :return: [(str, str, int, int)] as returned by write_employee_report
+    """
+    if db.database == ":memory:":
+        raise ValueError("Reports are read from the database file, they can't run on an in-memory database")
+
+    first_day, next_month = month_range(month)
+    jobs = [(user, first_day, next_month, output_dir) for user in employees_with_tasks(first_day, next_month)]
+    os.makedirs(output_dir, exist_ok=True)
+
+    with Pool(workers, initializer=open_read_only_database, initargs=(db.database,)) as pool:
+        return pool.map(write_employee_report, jobs)
+
+
+def show_per_employee_reports(month: str, output_dir: str, workers: int = None):
+    """
+    Runs per_employee_reports and shows the throughput
+    :param month: str, as yyyy-mm
+    :param output_dir: str
+    :param workers: int
+    :return: None
+    """
+    start = perf_counter()
+    reports = per_employee_reports(month, output_dir, workers)
+    elapsed = perf_counter() - start
+
+    for user, path, number_of_tasks, total_minutes in reports:
+        print("{}: {} tasks, {} minutes --- {}".format(term.bold(user), number_of_tasks, total_minutes, path))
+    number_of_tasks = sum(report[2] for report in reports)
+    print("{} reports, {} tasks in {:.2f} s ({:.1f} reports/s, {:.0f} tasks/s)".format(
+        len(reports), number_of_tasks, elapsed, len(reports) / elapsed, number_of_tasks / elapsed))
+
+
 def quit_script():
     logging.info("User chose to exit the script")
     exit(0)
 
 
-def main():
+def main(argv=None):
     """
     Main Function
+    :param argv: [str] command line arguments, sys.argv by default
     :return: None
     """
+    parser = argparse.ArgumentParser(description="Work log")
+    commands = parser.add_subparsers(dest="command")
+    reports = commands.add_parser("reports", help="write timesheet reports")
+    reports.add_argument("--per-employee", action="store_true", help="one timesheet per employee")
+    reports.add_argument("--month", required=True, help="month to report, as yyyy-mm")
+    reports.add_argument("--output-dir", default="reports", help="where to write the reports")
+    reports.add_argument("--workers", type=int, help="number of worker processes, one per CPU by default")
+    serve = commands.add_parser("serve", help="run the task writer for other work log processes")
+    serve.add_argument("--address", default=os.environ.get("WORKLOG_WRITER", DEFAULT_WRITER_ADDRESS),
+                       help="host:port to listen on")
+    args = parser.parse_args(argv)
+    authkey = os.environ.get("WORKLOG_WRITER_KEY", "").encode()
 
     initialize()
 
+    if args.command == "serve":
+        if not authkey:
+            serve.error("set WORKLOG_WRITER_KEY, clients need the same key to connect")
+        try:
+            serve_task_writer(args.address, authkey)
+        except ValueError as error:
+            serve.error("{}, set WORKLOG_STORAGE=file".format(error))
+        return None
+
+    if args.command == "reports":
+        if not args.per_employee:
+            reports.error("choose a report, only --per-employee is available")
+        try:
+            month_range(args.month)
+        except ValueError:
+            reports.error("enter the month as yyyy-mm")
+        try:
+            show_per_employee_reports(args.month, args.output_dir, args.workers)
+        except ValueError as error:
+            reports.error("{}, set WORKLOG_STORAGE=file".format(error))
+        return None
+
+    if os.environ.get("WORKLOG_WRITER"):
+        # writes go to the task writer served by "wlogdb.py serve", reads still use the database directly
+        try:
+            connect_to_writer(parse_writer_address(os.environ["WORKLOG_WRITER"]), authkey)
+        except ValueError as error:
+            parser.error("{}, set WORKLOG_STORAGE=file".format(error))
+
     main_menu = OrderedDict([
         ('a', [add_task, "add task"]),
         ('s', [search_entries, "search entries"]),
+        ('u', [show_undo_delete, "undo last delete"]),
+        ('m', [show_maintenance_report, "maintain database"]),
         ('q', [quit_script, "quit script"]),
     ])
 